@@ -1,16 +1,20 @@
 import base64
+import json
 import math
 import os
+import threading
 import time
-from multiprocessing import Pool
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlparse
 
+import blosc2
 import gradio as gr
+import httpx
 import numpy as np
+import orjson
 import pytube
-import requests
-from processing_whisper import WhisperPrePostProcessor
+from processing_whisper import WhisperPrePostProcessor, ffmpeg_read_file, get_chunk_lengths, get_chunk_strides
 from transformers.models.whisper.tokenization_whisper import TO_LANGUAGE_CODE
-from transformers.pipelines.audio_utils import ffmpeg_read
 
 
 title = "Whisper JAX: The Fastest Whisper API ⚡️"
@@ -25,17 +29,27 @@ To skip the queue, you may wish to create your own inference endpoint, details f
 article = "Whisper large-v2 model by OpenAI. Backend running JAX on a TPU v4-8 through the generous support of the [TRC](https://sites.research.google/trc/about/) programme. Whisper JAX [code](https://github.com/sanchit-gandhi/whisper-jax) and Gradio demo by 🤗 Hugging Face."
 
 API_URL = os.getenv("API_URL")
-API_URL_FROM_FEATURES = os.getenv("API_URL_FROM_FEATURES")
+API_URL_FROM_FEATURES_MULTI = os.getenv("API_URL_FROM_FEATURES_MULTI")
+# if set, the raw audio is sent to the server, which computes the log-mel features on device
+API_URL_FROM_AUDIO = os.getenv("API_URL_FROM_AUDIO")
 language_names = sorted(TO_LANGUAGE_CODE.keys())
 CHUNK_LENGTH_S = 30
 BATCH_SIZE = 16
-NUM_PROC = 16
 FILE_LIMIT_MB = 1000
+CONCURRENCY_COUNT = 3
+YT_CACHE_SIZE = 128
+BLOSC2_CHUNK_SIZE = 16 * 1024 * 1024
+# minimum time between re-rendering the partial transcription, since each render post-processes all batches so far
+RENDER_INTERVAL_S = 1.0
+
+# re-use the same HTTP/2 connection across requests to skip the TLS handshake on every call, and multiplex any
+# concurrent requests over a single connection
+client = httpx.Client(http2=True, timeout=None)
 
 
 def query(payload):
-    response = requests.post(API_URL, json=payload)
-    return response.json(), response.status_code
+    response = client.post(API_URL, content=orjson.dumps(payload), headers={"Content-Type": "application/json"})
+    return orjson.loads(response.content), response.status_code
 
 
 def inference(inputs, task=None, return_timestamps=False):
@@ -58,23 +72,83 @@ def inference(inputs, task=None, return_timestamps=False):
     return text
 
 
-def chunked_query(payload):
-    response = requests.post(API_URL_FROM_FEATURES, json=payload)
-    return response.json()
-
-
-def forward(batch, task=None, return_timestamps=False):
-    feature_shape = batch["input_features"].shape
-    batch["input_features"] = base64.b64encode(batch["input_features"].tobytes()).decode()
-    outputs = chunked_query(
-        {"batch": batch, "task": task, "return_timestamps": return_timestamps, "feature_shape": feature_shape}
-    )
-    outputs["tokens"] = np.asarray(outputs["tokens"])
-    return outputs
-
-
-def identity(batch):
-    return batch
+def chunked_query(url, array, headers):
+    # send the array as compressed raw bytes, with its metadata passed in the headers: audio and log-mel features are
+    # highly compressible, which cuts the upload time on bandwidth-bound connections
+    # a single blosc2 call can only compress up to 2GB, so the array is compressed as a super-chunk: a frame of
+    # fixed-size chunks, which has no limit on its total size
+    cparams = {"typesize": array.itemsize, "clevel": 3, "codec": blosc2.Codec.ZSTD}
+    data = blosc2.SChunk(chunksize=BLOSC2_CHUNK_SIZE, data=array, cparams=cparams).to_cframe()
+    headers = {
+        "Content-Type": "application/octet-stream",
+        "X-Compression": "blosc2",
+        "X-Shape": json.dumps(array.shape),
+        "X-Dtype": str(array.dtype),
+        **headers,
+    }
+    # the server streams back the generated tokens as one JSON line per batch, as soon as each batch completes
+    with client.stream("POST", url, content=data, headers=headers) as response:
+        if response.status_code != 200:
+            response.read()
+            try:
+                detail = orjson.loads(response.content)["detail"]
+            except (orjson.JSONDecodeError, KeyError, TypeError):
+                detail = response.text
+            raise gr.Error(f"The transcription request failed with status {response.status_code}: {detail}")
+
+        for line in response.iter_lines():
+            if line:
+                outputs = orjson.loads(line)
+                if "detail" in outputs:
+                    # errors raised by the server once the response has started streaming are sent as a final line
+                    raise gr.Error(f"An error occurred during transcription: {outputs['detail']}")
+                yield outputs
+
+
+def decode_tokens(outputs):
+    # the tokens are sent as the base64-encoded bytes of an int32 array
+    tokens = base64.b64decode(outputs["tokens_b64"])
+    return np.frombuffer(tokens, dtype=np.int32).reshape(outputs["tokens_shape"])
+
+
+def generation_headers(task=None, return_timestamps=False):
+    headers = {"X-Return-Timestamps": json.dumps(return_timestamps)}
+    if task is not None:
+        headers["X-Task"] = task
+    return headers
+
+
+def forward(input_features, strides, task=None, return_timestamps=False):
+    # send all batches in a single request, and yield the outputs for each batch as they are streamed back
+    headers = generation_headers(task, return_timestamps)
+
+    start_idx = 0
+    for outputs in chunked_query(API_URL_FROM_FEATURES_MULTI, input_features, headers):
+        tokens = decode_tokens(outputs)
+        end_idx = start_idx + len(tokens)
+        yield {"tokens": tokens, "stride": strides[start_idx:end_idx]}
+        start_idx = end_idx
+
+
+def forward_audio(inputs, task=None, return_timestamps=False):
+    # send the raw audio in a single request, leaving both the chunking and the feature extraction to the server
+    # the STFT runs in float32 on the server, so the audio is sent at full precision (down-casting it to float16 would
+    # cost far more accuracy in the log-mel features than down-casting the features themselves). blosc2 compresses it
+    audio = inputs["array"].astype(np.float32, copy=False)
+    headers = {"X-Sampling-Rate": str(inputs["sampling_rate"]), **generation_headers(task, return_timestamps)}
+    for outputs in chunked_query(API_URL_FROM_AUDIO, audio, headers):
+        yield {"tokens": decode_tokens(outputs), "stride": outputs["stride"]}
+
+
+def get_yt_video_id(yt_url):
+    # handles the long (youtube.com/watch?v=ID), short (youtu.be/ID) and embed / shorts URL formats, as well as any
+    # additional query parameters
+    url = urlparse(yt_url)
+    if url.hostname == "youtu.be":
+        return url.path.lstrip("/")
+    if url.path.startswith(("/embed/", "/shorts/", "/v/")):
+        return url.path.split("/")[2]
+    return parse_qs(url.query).get("v", [yt_url])[0]
 
 
 # Copied from https://github.com/openai/whisper/blob/c09a7ae299c4c34c5839a76380ae407e7d785914/whisper/utils.py#L50
@@ -100,32 +174,67 @@ def format_timestamp(seconds: float, always_include_hours: bool = False, decimal
 
 if __name__ == "__main__":
     processor = WhisperPrePostProcessor.from_pretrained("openai/whisper-large-v2")
-    stride_length_s = CHUNK_LENGTH_S / 6
-    chunk_len = round(CHUNK_LENGTH_S * processor.feature_extractor.sampling_rate)
-    stride_left = stride_right = round(stride_length_s * processor.feature_extractor.sampling_rate)
-    step = chunk_len - stride_left - stride_right
-    pool = Pool(NUM_PROC)
+    chunk_len, stride_left, stride_right = get_chunk_lengths(CHUNK_LENGTH_S, processor.feature_extractor.sampling_rate)
 
     def tqdm_generate(inputs: dict, task: str, return_timestamps: bool, progress: gr.Progress):
-        inputs_len = inputs["array"].shape[0]
-        all_chunk_start_idx = np.arange(0, inputs_len, step)
+        # the same chunking is used by the server when it's sent the raw audio
+        all_chunk_start_idx, _ = get_chunk_strides(inputs["array"].shape[0], chunk_len, stride_left, stride_right)
         num_samples = len(all_chunk_start_idx)
+        # the server streams back one line per batch of BATCH_SIZE chunks
         num_batches = math.ceil(num_samples / BATCH_SIZE)
-        dummy_batches = list(
-            range(num_batches)
-        )  # Gradio progress bar not compatible with generator, see https://github.com/gradio-app/gradio/issues/3841
 
-        dataloader = processor.preprocess_batch(inputs, chunk_length_s=CHUNK_LENGTH_S, batch_size=BATCH_SIZE)
-        progress(0, desc="Pre-processing audio file...")
-        dataloader = pool.map(identity, dataloader)
+        if API_URL_FROM_AUDIO is not None:
+            # skip the pre-processing on the CPU, and let the server compute the input features on device
+            progress(0, desc="Transcribing...")
+            start_time = time.time()
+            model_outputs_iter = forward_audio(inputs, task=task, return_timestamps=return_timestamps)
+        else:
+            progress(0, desc="Pre-processing audio file...")
+            # the features of every batch are written straight into a single upload array. The model runs in
+            # half-precision on the server, so we can store them in float16 to halve the upload size for free
+            input_features = np.empty(
+                (num_samples, processor.feature_extractor.feature_size, processor.feature_extractor.nb_max_frames),
+                dtype=np.float16,
+            )
+            dataloader = processor.preprocess_batch(
+                inputs, chunk_length_s=CHUNK_LENGTH_S, batch_size=BATCH_SIZE, out=input_features
+            )
+            strides = [stride for batch in dataloader for stride in batch["stride"]]
 
+            progress(0, desc="Transcribing...")
+            start_time = time.time()
+            model_outputs_iter = forward(input_features, strides, task=task, return_timestamps=return_timestamps)
+
+        # post-process the partial outputs as they are streamed back, such that the transcription is rendered
+        # progressively instead of only once the whole file is done
         model_outputs = []
-        start_time = time.time()
-        # iterate over our chunked audio samples
-        for batch, _ in zip(dataloader, progress.tqdm(dummy_batches, desc="Transcribing...")):
-            model_outputs.append(forward(batch, task=task, return_timestamps=return_timestamps))
-        runtime = time.time() - start_time
+        num_chunks = 0
+        next_render_time = 0.0
+        for batch_idx, outputs in enumerate(model_outputs_iter):
+            # Gradio's progress.tqdm is not compatible with generators (see
+            # https://github.com/gradio-app/gradio/issues/3841), so we update the progress bar by hand
+            progress((batch_idx + 1) / num_batches, desc="Transcribing...")
+            model_outputs.append(outputs)
+            num_chunks += len(outputs["tokens"])
+            runtime = time.time() - start_time
+
+            # post-processing re-decodes every batch received so far, so re-rendering the partial transcription for
+            # every batch would be quadratic in the number of batches. Instead, we wait at least RENDER_INTERVAL_S (or
+            # four times as long as the last render took, for long files) between renders, and always render the last
+            if num_chunks < num_samples and time.time() < next_render_time:
+                continue
+            render_start = time.time()
+            text = postprocess_text(model_outputs, return_timestamps)
+            next_render_time = time.time() + max(RENDER_INTERVAL_S, 4 * (time.time() - render_start))
+            yield text, runtime
+
+        if num_chunks != num_samples:
+            # the stream ended early, so the transcription is incomplete
+            raise gr.Error(
+                f"The transcription ended early: got {num_chunks} of {num_samples} audio chunks. Please try again."
+            )
 
+    def postprocess_text(model_outputs, return_timestamps):
         post_processed = processor.postprocess(model_outputs, return_timestamps=return_timestamps)
         text = post_processed["text"]
         timestamps = post_processed.get("chunks")
@@ -135,7 +244,7 @@ if __name__ == "__main__":
                 for chunk in timestamps
             ]
             text = "\n".join(str(feature) for feature in timestamps)
-        return text, runtime
+        return text
 
     def transcribe_chunked_audio(inputs, task, return_timestamps, progress=gr.Progress()):
         progress(0, desc="Loading audio file...")
@@ -147,16 +256,16 @@ if __name__ == "__main__":
                 f"File size exceeds file size limit. Got file of size {file_size_mb:.2f}MB for a limit of {FILE_LIMIT_MB}MB."
             )
 
-        with open(inputs, "rb") as f:
-            inputs = f.read()
-
-        inputs = ffmpeg_read(inputs, processor.feature_extractor.sampling_rate)
+        inputs = ffmpeg_read_file(inputs, processor.feature_extractor.sampling_rate)
         inputs = {"array": inputs, "sampling_rate": processor.feature_extractor.sampling_rate}
-        text, runtime = tqdm_generate(inputs, task=task, return_timestamps=return_timestamps, progress=progress)
-        return text, runtime
+        yield from tqdm_generate(inputs, task=task, return_timestamps=return_timestamps, progress=progress)
 
-    def _return_yt_html_embed(yt_url):
-        video_id = yt_url.split("?v=")[-1]
+    # transcriptions of recently requested YouTube videos, keyed by (video_id, task, return_timestamps). The cache is
+    # shared by all of the concurrent Gradio workers, so every access goes through the lock
+    yt_cache = OrderedDict()
+    yt_cache_lock = threading.Lock()
+
+    def _return_yt_html_embed(video_id):
         HTML_str = (
             f'<center> <iframe width="500" height="320" src="https://www.youtube.com/embed/{video_id}"> </iframe>'
             " </center>"
@@ -165,7 +274,21 @@ if __name__ == "__main__":
 
     def transcribe_youtube(yt_url, task, return_timestamps, progress=gr.Progress(), max_filesize=75.0):
         progress(0, desc="Loading audio file...")
-        html_embed_str = _return_yt_html_embed(yt_url)
+        video_id = get_yt_video_id(yt_url)
+        html_embed_str = _return_yt_html_embed(video_id)
+
+        cache_key = (video_id, task, return_timestamps)
+        with yt_cache_lock:
+            cached = yt_cache.get(cache_key)
+            if cached is not None:
+                yt_cache.move_to_end(cache_key)
+        if cached is not None:
+            # repeated submissions of the same video are returned straight away, without re-downloading or
+            # re-transcribing the audio
+            text, runtime = cached
+            yield html_embed_str, text, runtime
+            return
+
         try:
             yt = pytube.YouTube(yt_url)
             stream = yt.streams.filter(only_audio=True)[0]
@@ -177,13 +300,19 @@ if __name__ == "__main__":
 
         stream.download(filename="audio.mp3")
 
-        with open("audio.mp3", "rb") as f:
-            inputs = f.read()
-
-        inputs = ffmpeg_read(inputs, processor.feature_extractor.sampling_rate)
+        inputs = ffmpeg_read_file("audio.mp3", processor.feature_extractor.sampling_rate)
         inputs = {"array": inputs, "sampling_rate": processor.feature_extractor.sampling_rate}
-        text, runtime = tqdm_generate(inputs, task=task, return_timestamps=return_timestamps, progress=progress)
-        return html_embed_str, text, runtime
+        outputs = None
+        for outputs in tqdm_generate(inputs, task=task, return_timestamps=return_timestamps, progress=progress):
+            yield (html_embed_str, *outputs)
+
+        # tqdm_generate raises if the stream ends before every chunk is transcribed, so reaching this point means the
+        # last outputs hold the complete transcription - only then is it safe to cache
+        if outputs is not None:
+            with yt_cache_lock:
+                yt_cache[cache_key] = outputs
+                if len(yt_cache) > YT_CACHE_SIZE:
+                    yt_cache.popitem(last=False)
 
     microphone_chunked = gr.Interface(
         fn=transcribe_chunked_audio,
@@ -244,5 +373,5 @@ if __name__ == "__main__":
     with demo:
         gr.TabbedInterface([microphone_chunked, audio_chunked, youtube], ["Microphone", "Audio File", "YouTube"])
 
-    demo.queue(concurrency_count=3, max_size=5)
+    demo.queue(concurrency_count=CONCURRENCY_COUNT, max_size=5)
     demo.launch(show_api=False, max_threads=10)
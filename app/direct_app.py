@@ -1,15 +1,14 @@
 import math
 import os
 import time
-from multiprocessing import Pool
 
 import gradio as gr
 import jax.numpy as jnp
 import numpy as np
 import pytube
 from jax.experimental.compilation_cache import compilation_cache as cc
+from processing_whisper import ffmpeg_read_file
 from transformers.models.whisper.tokenization_whisper import TO_LANGUAGE_CODE
-from transformers.pipelines.audio_utils import ffmpeg_read
 
 from whisper_jax import FlaxWhisperPipline
 
@@ -18,7 +17,6 @@ cc.initialize_cache("./jax_cache")
 checkpoint = "openai/whisper-large-v2"
 BATCH_SIZE = 16
 CHUNK_LENGTH_S = 30
-NUM_PROC = 8
 FILE_LIMIT_MB = 1000
 YT_ATTEMPT_LIMIT = 3
 
@@ -36,10 +34,6 @@ article = "Whisper large-v2 model by OpenAI. Backend running JAX on a TPU v4-8 t
 language_names = sorted(TO_LANGUAGE_CODE.keys())
 
 
-def identity(batch):
-    return batch
-
-
 # Copied from https://github.com/openai/whisper/blob/c09a7ae299c4c34c5839a76380ae407e7d785914/whisper/utils.py#L50
 def format_timestamp(seconds: float, always_include_hours: bool = False, decimal_marker: str = "."):
     if seconds is not None:
@@ -67,7 +61,6 @@ if __name__ == "__main__":
     chunk_len = round(CHUNK_LENGTH_S * pipeline.feature_extractor.sampling_rate)
     stride_left = stride_right = round(stride_length_s * pipeline.feature_extractor.sampling_rate)
     step = chunk_len - stride_left - stride_right
-    pool = Pool(NUM_PROC)
 
     def tqdm_generate(inputs: dict, task: str, return_timestamps: bool, progress: gr.Progress):
         inputs_len = inputs["array"].shape[0]
@@ -80,7 +73,9 @@ if __name__ == "__main__":
 
         dataloader = pipeline.preprocess_batch(inputs, chunk_length_s=CHUNK_LENGTH_S, batch_size=BATCH_SIZE)
         progress(0, desc="Pre-processing audio file...")
-        dataloader = pool.map(identity, dataloader)
+        # pre-process all batches up-front in this process - dispatching the batches to worker processes only adds
+        # pickling overhead, since the dataloader is consumed sequentially in the parent process anyway
+        dataloader = list(dataloader)
 
         model_outputs = []
         start_time = time.time()
@@ -112,10 +107,7 @@ if __name__ == "__main__":
                 f"File size exceeds file size limit. Got file of size {file_size_mb:.2f}MB for a limit of {FILE_LIMIT_MB}MB."
             )
 
-        with open(inputs, "rb") as f:
-            inputs = f.read()
-
-        inputs = ffmpeg_read(inputs, pipeline.feature_extractor.sampling_rate)
+        inputs = ffmpeg_read_file(inputs, pipeline.feature_extractor.sampling_rate)
         inputs = {"array": inputs, "sampling_rate": pipeline.feature_extractor.sampling_rate}
         text, runtime = tqdm_generate(inputs, task=task, return_timestamps=return_timestamps, progress=progress)
         return text, runtime
@@ -146,10 +138,7 @@ if __name__ == "__main__":
 
         stream.download(filename="audio.mp3")
 
-        with open("audio.mp3", "rb") as f:
-            inputs = f.read()
-
-        inputs = ffmpeg_read(inputs, pipeline.feature_extractor.sampling_rate)
+        inputs = ffmpeg_read_file("audio.mp3", pipeline.feature_extractor.sampling_rate)
         inputs = {"array": inputs, "sampling_rate": pipeline.feature_extractor.sampling_rate}
         text, runtime = tqdm_generate(inputs, task=task, return_timestamps=return_timestamps, progress=progress)
         return html_embed_str, text, runtime
@@ -1,11 +1,21 @@
+import asyncio
 import base64
+import json
+import math
+from collections import deque
 
+import blosc2
+import jax
 import jax.numpy as jnp
 import numpy as np
+import orjson
 import pytube
 import requests
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from jax.experimental.compilation_cache import compilation_cache as cc
+from processing_whisper import get_chunk_lengths, get_chunk_strides, get_stft_window_and_mel_filters
 from transformers.models.whisper.tokenization_whisper import TO_LANGUAGE_CODE
 from transformers.pipelines.audio_utils import ffmpeg_read
 
@@ -13,16 +23,270 @@ from whisper_jax import FlaxWhisperPipline
 
 
 cc.initialize_cache("./jax_cache")
+try:
+    # persist every compiled program, not just the expensive ones, such that a restart doesn't re-compile anything
+    jax.config.update("jax_persistent_cache_min_entry_size_bytes", 0)
+except AttributeError:
+    # older versions of jax don't have this option and cache all entries regardless
+    pass
 checkpoint = "openai/whisper-large-v2"
 batch_size = 16
 chunk_length_s = 30
+# maximum number of samples to accumulate across requests, and maximum time to wait for them, before running generation
+# (matching the largest batch bucket, such that full batches run without any padding)
+max_batch_size = batch_size
+batch_timeout_s = 0.02
+# maximum number of batches that a single request to a streaming endpoint can have queued for generation at once, such
+# that a long file can't hold up the requests that arrive after it
+max_inflight_batches = 2
 
 pipeline = FlaxWhisperPipline(checkpoint, dtype=jnp.bfloat16)
 
 language_codes = {lang: f"<|{TO_LANGUAGE_CODE[lang]}|>" for lang in TO_LANGUAGE_CODE}
 generation_config = pipeline.model.generation_config
 
-app = FastAPI()
+# static batch sizes that generation is compiled for: inputs are padded up to the nearest bucket (and split into chunks
+# of the largest bucket) such that a new batch size never triggers a re-compilation. Each bucket has to be a multiple
+# of the number of devices
+batch_buckets = sorted(
+    {math.ceil(size / pipeline.min_batch_size) * pipeline.min_batch_size for size in (1, 4, batch_size)}
+)
+
+
+# the STFT window and mel filter bank are constant, so we build them once and keep them on device
+n_fft = pipeline.feature_extractor.n_fft
+hop_length = pipeline.feature_extractor.hop_length
+n_samples = pipeline.feature_extractor.n_samples
+stft_window, mel_filters = get_stft_window_and_mel_filters(pipeline.feature_extractor)
+stft_window, mel_filters = jnp.asarray(stft_window), jnp.asarray(mel_filters)
+
+
+@jax.jit
+def log_mel_spectrogram(waveforms):
+    """
+    On-device equivalent of the Whisper feature extractor, computing the log-mel input features for a batch of audio
+    chunks that are already padded / truncated to 30s.
+    """
+    # centred STFT: reflect-pad the waveforms and take overlapping, windowed frames
+    waveforms = jnp.pad(waveforms, ((0, 0), (n_fft // 2, n_fft // 2)), mode="reflect")
+    num_frames = 1 + (waveforms.shape[-1] - n_fft) // hop_length
+    frame_idx = hop_length * jnp.arange(num_frames)[:, None] + jnp.arange(n_fft)[None, :]
+    stft = jnp.fft.rfft(waveforms[:, frame_idx] * stft_window, axis=-1)
+    # the last frame is dropped, as in the original Whisper implementation
+    magnitudes = jnp.abs(stft[:, :-1]) ** 2
+
+    mel_spec = jnp.einsum("mf,btf->bmt", mel_filters, magnitudes)
+    log_spec = jnp.log10(jnp.maximum(mel_spec, 1e-10))
+    log_spec = jnp.maximum(log_spec, log_spec.max(axis=(1, 2), keepdims=True) - 8.0)
+    log_spec = (log_spec + 4.0) / 4.0
+    return log_spec.astype(pipeline.dtype)
+
+
+def chunk_audio(inputs, chunk_length_s=chunk_length_s, stride_length_s=None):
+    # split the audio into overlapping chunks, as done by the client's `preprocess_batch`, but without computing the
+    # input features - the strides are returned for post-processing
+    chunk_len, stride_left, stride_right = get_chunk_lengths(
+        chunk_length_s, pipeline.feature_extractor.sampling_rate, stride_length_s
+    )
+    chunk_start_idx, strides = get_chunk_strides(inputs.shape[0], chunk_len, stride_left, stride_right)
+
+    waveforms = np.zeros((len(chunk_start_idx), n_samples), dtype=np.float32)
+    for i, chunk_start in enumerate(chunk_start_idx):
+        chunk = inputs[chunk_start : chunk_start + min(chunk_len, n_samples)]
+        waveforms[i, : len(chunk)] = chunk
+    return waveforms, strides
+
+
+def iter_generate_bucketed(
+    inputs, language=None, task=None, return_timestamps=False, max_length=None, feature_fn=None
+):
+    # yields the generated tokens for one (padded) bucket of the inputs at a time
+    for start_idx in range(0, len(inputs), batch_buckets[-1]):
+        batch = inputs[start_idx : start_idx + batch_buckets[-1]]
+        input_batch_size = len(batch)
+
+        bucket_size = next(size for size in batch_buckets if size >= input_batch_size)
+        if bucket_size != input_batch_size:
+            padding = np.zeros([bucket_size - input_batch_size, *batch.shape[1:]], batch.dtype)
+            batch = np.concatenate([batch, padding])
+
+        if feature_fn is not None:
+            # compute the input features from the (padded) inputs on device
+            batch = feature_fn(batch)
+
+        yield pipeline.generate(
+            batch, language=language, task=task, return_timestamps=return_timestamps, max_length=max_length
+        )[:input_batch_size]
+
+
+def generate_bucketed(inputs, **generate_kwargs):
+    return np.concatenate(list(iter_generate_bucketed(inputs, **generate_kwargs)))
+
+
+def stream_line(chunk_idx, pred_ids, **kwargs):
+    # tokenizer's decode method expects an extra dim - we insert it here for convenience
+    tokens = np.asarray(pred_ids, dtype=np.int32)[:, None, :]
+    # send the tokens as the base64-encoded bytes of an int32 array, which is far more compact than a JSON list of ints
+    line = {
+        "chunk_idx": chunk_idx,
+        "tokens_b64": base64.b64encode(tokens.tobytes()).decode(),
+        "tokens_shape": tokens.shape,
+        **kwargs,
+    }
+    return orjson.dumps(line) + b"\n"
+
+
+def stream_error(err):
+    # once a streaming response has started its status can no longer change, so errors raised during generation are
+    # sent as a final line holding the error detail instead
+    return orjson.dumps({"detail": f"{type(err).__name__}: {err}"}) + b"\n"
+
+
+class DynamicBatcher:
+    """
+    Accumulates the input features of concurrent requests and runs generation over them in a single call. A batch is
+    dispatched once it holds `max_batch_size` samples, or once `timeout_s` seconds have passed since its first request
+    arrived. Only requests with the same generation arguments are batched together.
+    """
+
+    def __init__(self, max_batch_size, timeout_s):
+        self.max_batch_size = max_batch_size
+        self.timeout_s = timeout_s
+        self.queue = None
+        self.task = None
+        self.next_request = None
+        # host buffers that the input features of each batch are copied into, one per bucket size. Batches are
+        # dispatched one at a time, so a single buffer per bucket can be re-used for every batch
+        self.buffers = {}
+
+    async def start(self):
+        # the queue has to be created inside the running event loop
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def submit(self, input_features, language=None, task=None, return_timestamps=False, max_length=None):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((input_features, (language, task, return_timestamps, max_length), future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.next_request is not None:
+                request, self.next_request = self.next_request, None
+            else:
+                request = await self.queue.get()
+            pending = [request]
+            num_samples = len(request[0])
+            deadline = loop.time() + self.timeout_s
+
+            while num_samples < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if request[1] != pending[0][1] or num_samples + len(request[0]) > self.max_batch_size:
+                    # incompatible with the current batch - hold it back as the first request of the next one
+                    self.next_request = request
+                    break
+                pending.append(request)
+                num_samples += len(request[0])
+
+            await self.dispatch(pending)
+
+    def fill_buffer(self, features_list):
+        # copy the features of each request straight into the (padded) bucket buffer, rather than concatenating them
+        # and then padding the result, which would copy the whole batch twice. Features may be sent in reduced
+        # precision to save bandwidth, so this copy also casts them to the dtype of the computation
+        num_samples = sum(len(features) for features in features_list)
+        # a single request can hold more samples than the largest bucket, in which case it's split into full buckets
+        max_bucket_size = batch_buckets[-1]
+        bucket_size = next(
+            (size for size in batch_buckets if size >= num_samples),
+            math.ceil(num_samples / max_bucket_size) * max_bucket_size,
+        )
+        shape = (bucket_size, *features_list[0].shape[1:])
+
+        if bucket_size in batch_buckets:
+            buffer = self.buffers.get(bucket_size)
+            if buffer is None or buffer.shape != shape:
+                buffer = self.buffers[bucket_size] = np.empty(shape, dtype=pipeline.dtype)
+        else:
+            # oversized requests can have any size, so their buffer is only allocated for this batch rather than kept
+            buffer = np.empty(shape, dtype=pipeline.dtype)
+
+        start_idx = 0
+        for features in features_list:
+            buffer[start_idx : start_idx + len(features)] = features
+            start_idx += len(features)
+        # zero the padding, which may still hold the features of an earlier batch
+        buffer[num_samples:] = 0
+        return buffer
+
+    async def dispatch(self, pending):
+        # skip any requests that were cancelled while waiting, e.g. because the client disconnected
+        pending = [request for request in pending if not request[2].done()]
+        if len(pending) == 0:
+            return
+
+        language, task, return_timestamps, max_length = pending[0][1]
+        futures = [future for _, _, future in pending]
+        try:
+            input_features = self.fill_buffer([features for features, _, _ in pending])
+
+            # run generation in a worker thread so that the event loop can keep accepting requests in the meantime
+            pred_ids = await run_in_threadpool(
+                generate_bucketed,
+                input_features,
+                language=language,
+                task=task,
+                return_timestamps=return_timestamps,
+                max_length=max_length,
+            )
+        except Exception as err:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(err)
+            return
+
+        # split the generated tokens back into the requests they came from (any rows past the last one are padding)
+        start_idx = 0
+        for features, _, future in pending:
+            end_idx = start_idx + len(features)
+            if not future.done():
+                future.set_result(pred_ids[start_idx:end_idx])
+            start_idx = end_idx
+
+
+def warmup():
+    # compile generation for every static shape we serve ahead of the first request: one program per bucket size and
+    # return_timestamps value, and per forced decoder ids length (which depends on whether a language is set). The
+    # compiled programs land in the persistent compilation cache, so restarts load them instead of re-compiling
+    for bucket_size in batch_buckets:
+        input_features = np.zeros((bucket_size, pipeline.feature_extractor.feature_size, 3000), dtype=pipeline.dtype)
+        for language in (None, "english"):
+            for return_timestamps in (False, True):
+                pred_ids = pipeline.generate(input_features, language=language, return_timestamps=return_timestamps)
+                jax.block_until_ready(pred_ids)
+
+        waveforms = np.zeros((bucket_size, n_samples), dtype=np.float32)
+        jax.block_until_ready(log_mel_spectrogram(waveforms))
+
+
+batcher = DynamicBatcher(max_batch_size=max_batch_size, timeout_s=batch_timeout_s)
+
+# orjson is considerably faster than the standard library json at (de-)serialising the long lists of tokens
+app = FastAPI(default_response_class=ORJSONResponse)
+
+
+@app.on_event("startup")
+async def start_batcher():
+    # run the warm-up before accepting requests, such that none of them has to wait for compilation
+    warmup()
+    await batcher.start()
 
 
 @app.get("/")
@@ -101,6 +365,13 @@ def check_inputs(inputs, language, task, return_timestamps):
             detail=f"We expect an audio input in the form of bytes or dictionary, but got {type(inputs)}.",
         )
 
+    language_token, task, return_timestamps = check_generation_args(language, task, return_timestamps)
+
+    return inputs, language_token, task, return_timestamps
+
+
+def check_generation_args(language, task, return_timestamps):
+    # validates the generation arguments, such that streaming endpoints can reject them before the response starts
     language_token = None
     if language is not None:
         if not isinstance(language, str):
@@ -145,16 +416,29 @@ def check_inputs(inputs, language, task, return_timestamps):
                 ),
             )
 
-    return inputs, language_token, task, return_timestamps
+    return language_token, task, return_timestamps
+
+
+def check_max_length(max_length):
+    # every distinct max length compiles a new generation program, so requested lengths are rounded up to the next
+    # power of two (capped at the pipeline's max length) to bound the number of compilations
+    if max_length is None:
+        return None
+    if not isinstance(max_length, int) or isinstance(max_length, bool) or max_length < 1:
+        raise HTTPException(
+            status_code=418, detail=f"max_length should be a positive integer number of tokens, got {max_length}."
+        )
+    return min(1 << (max_length - 1).bit_length(), pipeline.max_length)
 
 
 @app.post("/generate/")
 async def generate(request: Request):
-    content = await request.json()
+    content = orjson.loads(await request.body())
     inputs = content.get("inputs", None)
     language = content.get("language", None)
     task = content.get("task", "transcribe")
     return_timestamps = content.get("return_timestamps", False)
+    max_length = check_max_length(content.get("max_length", None))
 
     inputs, language_token, task, return_timestamps = check_inputs(inputs, language, task, return_timestamps)
 
@@ -163,6 +447,7 @@ async def generate(request: Request):
         language=language,
         task=task,
         return_timestamps=return_timestamps,
+        max_length=max_length,
         batch_size=batch_size,
         chunk_length_s=chunk_length_s,
     )
@@ -171,20 +456,172 @@ async def generate(request: Request):
 
 @app.post("/generate_from_features/")
 async def generate_from_features(request: Request):
-    content = await request.json()
+    content = orjson.loads(await request.body())
     batch = content.get("batch", None)
     feature_shape = content.get("feature_shape", None)
     language = content.get("language", None)
     task = content.get("task", "transcribe")
     return_timestamps = content.get("return_timestamps", False)
+    max_length = check_max_length(content.get("max_length", None))
 
-    batch["input_features"] = np.frombuffer(base64.b64decode(batch["input_features"]), dtype=np.float32).reshape(
-        feature_shape
+    input_features = np.frombuffer(base64.b64decode(batch["input_features"]), dtype=np.float32).reshape(feature_shape)
+    pred_ids = await batcher.submit(
+        input_features, language=language, task=task, return_timestamps=return_timestamps, max_length=max_length
     )
 
-    generation = pipeline.forward(
-        batch, batch_size=batch_size, language=language, task=task, return_timestamps=return_timestamps
-    )
-    generation["tokens"] = generation["tokens"].tolist()
+    # tokenizer's decode method expects an extra dim - we insert it here for convenience
+    generation = {"tokens": pred_ids[:, None, :].tolist()}
+    stride = batch.get("stride", None)
+    if stride is not None:
+        generation["stride"] = stride
 
     return generation
+
+
+async def read_array(request: Request, ndim):
+    # the request body holds the (optionally compressed) raw bytes of the array, with its shape and dtype passed in the
+    # headers
+    body = await request.body()
+    compression = request.headers.get("X-Compression", None)
+    if compression not in [None, "blosc2"]:
+        raise HTTPException(
+            status_code=418, detail=f"Unsupported compression {compression}. Compression should be one of: ['blosc2']"
+        )
+
+    if "X-Shape" not in request.headers:
+        raise HTTPException(status_code=418, detail="The shape of the array should be passed in the X-Shape header.")
+    try:
+        shape = json.loads(request.headers["X-Shape"])
+    except json.JSONDecodeError:
+        shape = None
+    if not isinstance(shape, list) or not all(isinstance(dim, int) and dim >= 0 for dim in shape):
+        raise HTTPException(
+            status_code=418, detail=f"X-Shape should be a list of non-negative ints, got {request.headers['X-Shape']}."
+        )
+    if len(shape) != ndim:
+        raise HTTPException(status_code=418, detail=f"We expect an array of rank {ndim}, got shape {shape}.")
+
+    dtype = request.headers.get("X-Dtype", "float32")
+    if dtype not in ["float16", "float32"]:
+        raise HTTPException(
+            status_code=418, detail=f"Unsupported dtype {dtype}. Dtype should be one of: ['float16', 'float32']"
+        )
+
+    def parse_array(body):
+        if compression == "blosc2":
+            body = blosc2.schunk_from_cframe(body)[:]
+        return np.frombuffer(body, dtype=dtype).reshape(shape)
+
+    try:
+        # decompressing a large upload takes a while, so run it in a worker thread rather than blocking the event loop
+        return await run_in_threadpool(parse_array, body)
+    except (RuntimeError, ValueError) as err:
+        raise HTTPException(
+            status_code=418, detail=f"Could not read an array of shape {shape} and dtype {dtype} from the body: {err}"
+        )
+
+
+def read_generation_headers(request: Request):
+    # the generation arguments of the streaming endpoints are validated up-front, since any error raised once the
+    # response has started streaming can no longer be returned with an error status
+    language = request.headers.get("X-Language", None)
+    task = request.headers.get("X-Task", "transcribe")
+    try:
+        return_timestamps = json.loads(request.headers.get("X-Return-Timestamps", "false"))
+    except json.JSONDecodeError:
+        return_timestamps = request.headers["X-Return-Timestamps"]
+
+    max_length = request.headers.get("X-Max-Length", None)
+    if max_length is not None:
+        max_length = int(max_length) if max_length.isdigit() else max_length
+    max_length = check_max_length(max_length)
+
+    check_generation_args(language, task, return_timestamps)
+    return language, task, return_timestamps, max_length
+
+
+@app.post("/generate_from_features_multi/")
+async def generate_from_features_multi(request: Request):
+    input_features = await read_array(request, ndim=3)
+    language, task, return_timestamps, max_length = read_generation_headers(request)
+
+    feature_shape = (pipeline.feature_extractor.feature_size, pipeline.feature_extractor.nb_max_frames)
+    if input_features.shape[1:] != feature_shape:
+        raise HTTPException(
+            status_code=418,
+            detail=f"We expect input features of shape (batch_size, {feature_shape[0]}, {feature_shape[1]}), got {input_features.shape}.",
+        )
+
+    # submit the features one batch at a time, such that the tokens for the first batches can be streamed back while
+    # the later ones are still generating
+    batches = [
+        input_features[start_idx : start_idx + max_batch_size]
+        for start_idx in range(0, len(input_features), max_batch_size)
+    ]
+
+    async def stream_tokens():
+        futures = deque()
+        next_batch_idx = 0
+        try:
+            for chunk_idx in range(len(batches)):
+                # only keep a couple of batches queued at once, such that the batches of other requests can take turns
+                # with ours rather than waiting for the whole of this file to be transcribed
+                while next_batch_idx < len(batches) and len(futures) < max_inflight_batches:
+                    future = batcher.submit(
+                        batches[next_batch_idx],
+                        language=language,
+                        task=task,
+                        return_timestamps=return_timestamps,
+                        max_length=max_length,
+                    )
+                    futures.append(asyncio.ensure_future(future))
+                    next_batch_idx += 1
+                pred_ids = await futures.popleft()
+                yield stream_line(chunk_idx, pred_ids)
+        except Exception as err:
+            yield stream_error(err)
+        finally:
+            # stop generating for the remaining batches if the client disconnects
+            for future in futures:
+                future.cancel()
+
+    return StreamingResponse(stream_tokens(), media_type="application/x-ndjson")
+
+
+@app.post("/generate_from_audio/")
+async def generate_from_audio(request: Request):
+    # the audio is expected to be single channel
+    inputs = await read_array(request, ndim=1)
+    sampling_rate = int(request.headers.get("X-Sampling-Rate", pipeline.feature_extractor.sampling_rate))
+    language, task, return_timestamps, max_length = read_generation_headers(request)
+
+    if sampling_rate != pipeline.feature_extractor.sampling_rate:
+        raise HTTPException(
+            status_code=418,
+            detail=f"We expect audio sampled at {pipeline.feature_extractor.sampling_rate}Hz, got {sampling_rate}Hz.",
+        )
+
+    # only the cheap chunking runs on the host: the log-mel features are computed on device, straight from the audio
+    waveforms, strides = chunk_audio(inputs)
+
+    def stream_tokens():
+        # this (synchronous) generator is run in a worker thread, streaming back the tokens for each bucket as it
+        # completes
+        pred_ids_iter = iter_generate_bucketed(
+            waveforms,
+            language=language,
+            task=task,
+            return_timestamps=return_timestamps,
+            max_length=max_length,
+            feature_fn=log_mel_spectrogram,
+        )
+        start_idx = 0
+        try:
+            for chunk_idx, pred_ids in enumerate(pred_ids_iter):
+                end_idx = start_idx + len(pred_ids)
+                yield stream_line(chunk_idx, pred_ids, stride=strides[start_idx:end_idx])
+                start_idx = end_idx
+        except Exception as err:
+            yield stream_error(err)
+
+    return StreamingResponse(stream_tokens(), media_type="application/x-ndjson")
@@ -1,43 +1,166 @@
 import math
+import subprocess
 
 import numpy as np
 from transformers import WhisperProcessor
 
 
+def ffmpeg_read_file(filename, sampling_rate):
+    """
+    Reads an audio file through ffmpeg, as done by `transformers.pipelines.audio_utils.ffmpeg_read`, but passing the
+    filename to ffmpeg directly such that the file is never read into memory and piped through Python.
+    """
+    ffmpeg_command = [
+        "ffmpeg",
+        "-i",
+        filename,
+        "-ac",
+        "1",
+        "-ar",
+        f"{sampling_rate}",
+        "-f",
+        "f32le",
+        "-hide_banner",
+        "-loglevel",
+        "quiet",
+        "pipe:1",
+    ]
+
+    try:
+        output_stream = subprocess.run(ffmpeg_command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE).stdout
+    except FileNotFoundError as error:
+        raise ValueError("ffmpeg was not found but is required to load audio files from filename") from error
+    audio = np.frombuffer(output_stream, np.float32)
+    if audio.shape[0] == 0:
+        raise ValueError(
+            "Soundfile is either not in the correct format or is malformed. Ensure that the soundfile has "
+            "a valid audio file extension (e.g. wav, flac or mp3) and is not corrupted."
+        )
+    return audio
+
+
+def get_stft_window_and_mel_filters(feature_extractor):
+    """
+    Returns the Hann window of the STFT and the `(num_mel_bins, num_freqs)` mel filter bank of the feature extractor,
+    as used to compute the log-mel input features on both the client (with numpy) and the server (with jax).
+    """
+    window = np.hanning(feature_extractor.n_fft + 1)[:-1].astype(np.float32)
+    mel_filters = np.asarray(feature_extractor.mel_filters, dtype=np.float32)
+    if mel_filters.shape[0] != feature_extractor.feature_size:
+        # newer versions of transformers store the filter bank as (num_freqs, num_mel_bins)
+        mel_filters = mel_filters.T
+    return window, mel_filters
+
+
+def get_chunk_lengths(chunk_length_s, sampling_rate, stride_length_s=None):
+    """
+    Returns the length of each audio chunk, and of its left and right strides, in samples.
+    """
+    if stride_length_s is None:
+        stride_length_s = chunk_length_s / 6
+
+    if isinstance(stride_length_s, (int, float)):
+        stride_length_s = [stride_length_s, stride_length_s]
+
+    chunk_len = round(chunk_length_s * sampling_rate)
+    stride_left = round(stride_length_s[0] * sampling_rate)
+    stride_right = round(stride_length_s[1] * sampling_rate)
+
+    if chunk_len < stride_left + stride_right:
+        raise ValueError("Chunk length must be superior to stride length.")
+    return chunk_len, stride_left, stride_right
+
+
+def get_chunk_strides(inputs_len, chunk_len, stride_left, stride_right):
+    """
+    Splits `inputs_len` samples of audio into overlapping chunks, returning the start index of each chunk and its
+    `(chunk_len, stride_left, stride_right)` stride, which is used to merge the transcriptions of the chunks.
+    """
+    step = chunk_len - stride_left - stride_right
+    chunk_start_idx = np.arange(0, inputs_len, step)
+    chunk_end_idx = chunk_start_idx + chunk_len
+
+    _stride_left = np.where(chunk_start_idx == 0, 0, stride_left)
+    is_last = np.where(stride_right > 0, chunk_end_idx > inputs_len, chunk_end_idx >= inputs_len)
+    _stride_right = np.where(is_last, 0, stride_right)
+
+    chunk_lens = np.minimum(chunk_end_idx, inputs_len) - chunk_start_idx
+    strides = [
+        (int(chunk_l), int(_stride_l), int(_stride_r))
+        for chunk_l, _stride_l, _stride_r in zip(chunk_lens, _stride_left, _stride_right)
+    ]
+    return chunk_start_idx, strides
+
+
 class WhisperPrePostProcessor(WhisperProcessor):
-    def chunk_iter_with_batch(self, inputs, chunk_len, stride_left, stride_right, batch_size):
-        inputs_len = inputs.shape[0]
-        step = chunk_len - stride_left - stride_right
+    def __init__(self, feature_extractor, tokenizer):
+        super().__init__(feature_extractor, tokenizer)
+        # the STFT window and mel filter bank are constant, so we build them once and re-use them for every batch
+        self.window, self.mel_filters = get_stft_window_and_mel_filters(self.feature_extractor)
 
-        all_chunk_start_idx = np.arange(0, inputs_len, step)
+    def log_mel_spectrogram(self, chunks, out=None):
+        """
+        Computes the log-mel input features for a batch of audio chunks, equivalent to calling the feature extractor,
+        but with a single vectorised STFT over the whole batch instead of a loop over the chunks. If `out` is passed,
+        the features are written into it instead of a newly allocated array.
+        """
+        n_fft = self.feature_extractor.n_fft
+        hop_length = self.feature_extractor.hop_length
+        n_samples = self.feature_extractor.n_samples
+
+        # pad / truncate each chunk to the 30s context window of the model, writing it straight into the middle of
+        # the buffer for the centred STFT, and then reflect-pad both ends in place (as `np.pad(mode="reflect")` would,
+        # but without copying the whole batch a second time)
+        pad = n_fft // 2
+        waveforms = np.zeros((len(chunks), n_samples + 2 * pad), dtype=np.float32)
+        for i, chunk in enumerate(chunks):
+            chunk = chunk[:n_samples]
+            waveforms[i, pad : pad + len(chunk)] = chunk
+        waveforms[:, :pad] = waveforms[:, 2 * pad : pad : -1]
+        waveforms[:, pad + n_samples :] = waveforms[:, pad + n_samples - 2 : n_samples - 2 : -1]
+
+        # take overlapping, windowed frames
+        frames = np.lib.stride_tricks.sliding_window_view(waveforms, n_fft, axis=-1)[:, ::hop_length]
+        stft = np.fft.rfft(frames * self.window, axis=-1)
+        # the last frame is dropped, as in the original Whisper implementation
+        stft = stft[:, :-1]
+        magnitudes = np.square(stft.real)
+        magnitudes += np.square(stft.imag)
+        del stft
+
+        # the remaining steps are all computed in place on the (much smaller) mel spectrogram
+        log_spec = np.matmul(self.mel_filters, magnitudes.transpose(0, 2, 1))
+        del magnitudes
+        np.maximum(log_spec, 1e-10, out=log_spec)
+        np.log10(log_spec, out=log_spec)
+        np.maximum(log_spec, log_spec.max(axis=(1, 2), keepdims=True) - 8.0, out=log_spec)
+        log_spec += 4.0
+        if out is None:
+            out = np.empty(log_spec.shape, dtype=np.float32)
+        # `out` may be of lower precision (e.g. float16 for upload), in which case the cast happens in this final step
+        return np.divide(log_spec, 4.0, out=out)
+
+    def chunk_iter_with_batch(self, inputs, chunk_len, stride_left, stride_right, batch_size, out=None):
+        all_chunk_start_idx, all_strides = get_chunk_strides(inputs.shape[0], chunk_len, stride_left, stride_right)
         num_samples = len(all_chunk_start_idx)
 
         num_batches = math.ceil(num_samples / batch_size)
         batch_idx = np.array_split(np.arange(num_samples), num_batches)
 
-        for i, idx in enumerate(batch_idx):
-            chunk_start_idx = all_chunk_start_idx[idx]
-
-            chunk_end_idx = chunk_start_idx + chunk_len
-
-            chunks = [inputs[chunk_start:chunk_end] for chunk_start, chunk_end in zip(chunk_start_idx, chunk_end_idx)]
-            processed = self.feature_extractor(
-                chunks, sampling_rate=self.feature_extractor.sampling_rate, return_tensors="np"
+        if out is not None and len(out) != num_samples:
+            raise ValueError(
+                f"Expected an output array with {num_samples} rows for the input features, got {len(out)}."
             )
 
-            _stride_left = np.where(chunk_start_idx == 0, 0, stride_left)
-            is_last = np.where(stride_right > 0, chunk_end_idx > inputs_len, chunk_end_idx >= inputs_len)
-            _stride_right = np.where(is_last, 0, stride_right)
-
-            chunk_lens = [chunk.shape[0] for chunk in chunks]
-            strides = [
-                (int(chunk_l), int(_stride_l), int(_stride_r))
-                for chunk_l, _stride_l, _stride_r in zip(chunk_lens, _stride_left, _stride_right)
-            ]
+        for i, idx in enumerate(batch_idx):
+            chunks = [inputs[chunk_start : chunk_start + chunk_len] for chunk_start in all_chunk_start_idx[idx]]
+            # write the features of this batch straight into its rows of `out`, if given
+            batch_out = out[idx[0] : idx[-1] + 1] if out is not None else None
+            processed = {"input_features": self.log_mel_spectrogram(chunks, out=batch_out)}
 
-            yield {"stride": strides, **processed}
+            yield {"stride": all_strides[idx[0] : idx[-1] + 1], **processed}
 
-    def preprocess_batch(self, inputs, chunk_length_s=0, stride_length_s=None, batch_size=None):
+    def preprocess_batch(self, inputs, chunk_length_s=0, stride_length_s=None, batch_size=None, out=None):
         stride = None
         if isinstance(inputs, dict):
             stride = inputs.pop("stride", None)
@@ -91,18 +214,9 @@ class WhisperPrePostProcessor(WhisperProcessor):
             stride = (inputs.shape[0], int(round(stride[0] * ratio)), int(round(stride[1] * ratio)))
 
         if chunk_length_s:
-            if stride_length_s is None:
-                stride_length_s = chunk_length_s / 6
-
-            if isinstance(stride_length_s, (int, float)):
-                stride_length_s = [stride_length_s, stride_length_s]
-
-            chunk_len = round(chunk_length_s * self.feature_extractor.sampling_rate)
-            stride_left = round(stride_length_s[0] * self.feature_extractor.sampling_rate)
-            stride_right = round(stride_length_s[1] * self.feature_extractor.sampling_rate)
-
-            if chunk_len < stride_left + stride_right:
-                raise ValueError("Chunk length must be superior to stride length.")
+            chunk_len, stride_left, stride_right = get_chunk_lengths(
+                chunk_length_s, self.feature_extractor.sampling_rate, stride_length_s
+            )
 
             for item in self.chunk_iter_with_batch(
                 inputs,
@@ -110,12 +224,11 @@ class WhisperPrePostProcessor(WhisperProcessor):
                 stride_left,
                 stride_right,
                 batch_size,
+                out=out,
             ):
                 yield item
         else:
-            processed = self.feature_extractor(
-                inputs, sampling_rate=self.feature_extractor.sampling_rate, return_tensors="np"
-            )
+            processed = {"input_features": self.log_mel_spectrogram([inputs])}
             if stride is not None:
                 processed["stride"] = stride
             yield processed
@@ -4,9 +4,11 @@ import time
 import datasets
 import jax
 import jax.numpy as jnp
+import numpy as np
 from datasets import concatenate_datasets, load_dataset
 from flax.core.frozen_dict import freeze
 from jax.experimental.compilation_cache import compilation_cache as cc
+from jax.sharding import NamedSharding
 from jax.sharding import PartitionSpec as P
 from transformers import WhisperConfig, WhisperProcessor
 
@@ -118,18 +120,34 @@ def main():
 
     p_shard_params = partitioner.partition(model.to_bf16, (params_spec,), params_spec)
 
-    def generate(params, input_features):
-        output_ids = model.generate(input_features, params=params, max_new_tokens=25).sequences
+    def generate(params, input_features, max_new_tokens):
+        output_ids = model.generate(input_features, params=params, max_new_tokens=max_new_tokens).sequences
         return output_ids
 
+    def scan_generate(params, input_features, max_new_tokens):
+        # generate for a stack of batches in a single call, scanning over the leading (batch index) dim on device
+        # rather than launching generate from a Python loop once per batch
+        def step(carry, batch):
+            return carry, generate(params, batch, max_new_tokens)
+
+        _, output_ids = jax.lax.scan(step, None, input_features)
+        return output_ids
+
+    # max_new_tokens sets the static size of the output buffer, so we compile once per value of it
     p_generate = partitioner.partition(
-        generate,
-        in_axis_resources=(params_spec, P("data")),
-        out_axis_resources=P("data"),
+        scan_generate,
+        in_axis_resources=(params_spec, P(None, "data")),
+        out_axis_resources=P(None, "data"),
+        static_argnums=(2,),
     )
 
     # This will auto-magically run in mesh context
-    params = p_shard_params(freeze(params))
+    # freeze once, rather than on every step
+    params = freeze(p_shard_params(freeze(params)))
+
+    # input features are stacked into (num_batches, batch_size, ...) and sharded along the batch dim over the data
+    # axis of the mesh
+    input_sharding = NamedSharding(partitioner.mesh, P(None, "data"))
 
     for batch_size in BATCH_SIZES:
         eval_dataset = dataset_processed.select(range(batch_size // 2))
@@ -137,13 +155,18 @@ def main():
 
         eval_dataloader = eval_dataset.with_format("numpy").iter(batch_size=batch_size)
 
-        # warm-up step
-        batch = next(iter(eval_dataloader))
-        p_generate(freeze(params), batch["input_features"])
+        # transfer and shard the input features up-front, such that generate receives arrays that are already
+        # on-device with the expected sharding, and we don't time the host-to-device copy
+        input_features = np.stack([batch["input_features"] for batch in eval_dataloader])
+        input_features = jax.device_put(input_features, input_sharding)
+
+        # warm-up step - jax dispatches asynchronously, so we block on the results whenever timing
+        pred_ids = p_generate(params, input_features, NUM_TOKENS)
+        pred_ids.block_until_ready()
 
         start = time.time()
-        for batch in eval_dataloader:
-            p_generate(freeze(params), batch["input_features"])
+        pred_ids = p_generate(params, input_features, NUM_TOKENS)
+        pred_ids.block_until_ready()
         runtime = time.time() - start
 
         print(f"{batch_size}: {runtime:.06}")
@@ -105,10 +105,11 @@ p_generate = partitioner.partition(
 )
 
 # This will auto-magically run in mesh context
-params = p_shard_params(freeze(params))
+params = freeze(p_shard_params(freeze(params)))
 
 # warm-up
-pred_ids = p_generate(freeze(params), np.ones((BATCH_SIZE, 80, 3000)))
+pred_ids = p_generate(params, np.ones((BATCH_SIZE, 80, 3000)))
+pred_ids.block_until_ready()
 
 # processors/tokenizers are the same for all models, so just load from tiny and preprocess once
 processor = WhisperProcessor.from_pretrained("openai/whisper-large-v2")
@@ -146,8 +147,10 @@ for i, batch in tqdm(enumerate(eval_dataloader)):
         input_features = np.concatenate([input_features, padding])
 
     generate_start = time.time()
-    pred_ids = p_generate(freeze(params), input_features)[:input_batch_size]
+    pred_ids = p_generate(params, input_features)
+    pred_ids.block_until_ready()
     generate_runtime = time.time() - generate_start
+    pred_ids = pred_ids[:input_batch_size]
     all_runtimes += generate_runtime
 
     pred_str = processor.batch_decode(pred_ids, skip_special_tokens=True)
@@ -52,11 +52,13 @@ for batch_size in BATCH_SIZES:
     batch = next(iter(eval_dataloader))
     input_features = shard(batch["input_features"])
     pred_ids = p_generate_fn(input_features)
+    pred_ids.block_until_ready()
 
     start = time.time()
     for batch in eval_dataloader:
         input_features = shard(batch["input_features"])
         pred_ids = p_generate_fn(input_features)
+    pred_ids.block_until_ready()
     runtime = time.time() - start
 
     print(f"{batch_size}: {runtime:.06}")
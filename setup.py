@@ -35,6 +35,9 @@ _extras_dev_deps = [
 _extras_endpoint_deps = [
     "gradio>=3.25.0",
     "requests>=2.28.2",
+    "httpx[http2]>=0.23.0",
+    "blosc2>=2.0.0",
+    "orjson>=3.8.0",
     "fastapi>=0.95.0",
     "uvicorn>=0.21.1",
     "pytube>=12.1.3",
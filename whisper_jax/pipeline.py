@@ -97,20 +97,21 @@ class FlaxWhisperPipline:
             batch_size if batch_size is not None else self.min_batch_size
         )  # we need a minimum of 1 batch per-device
 
-        def generate(params, input_features, forced_decoder_ids, return_timestamps):
+        def generate(params, input_features, forced_decoder_ids, return_timestamps, max_length):
             output_ids = self.model.pipeline_generate(
                 input_features,
                 params=params,
                 forced_decoder_ids=forced_decoder_ids,
                 return_timestamps=return_timestamps,
-                max_length=self.max_length,
+                max_length=max_length,
             )
             return output_ids
 
         # use pmap for DP by default - this is compatible on a Colab TPU v2
-        self.params = jax_utils.replicate(self.params)
+        # freeze the params once here rather than on every call to generate, which would re-build the whole tree
+        self.params = freeze(jax_utils.replicate(self.params))
         self.p_generate = jax.pmap(
-            generate, "input_features", in_axes=(0, 0, None), out_axes=0, static_broadcasted_argnums=(3,)
+            generate, "input_features", in_axes=(0, 0, None), out_axes=0, static_broadcasted_argnums=(3, 4)
         )
         self.is_sharded = False
 
@@ -160,16 +161,16 @@ class FlaxWhisperPipline:
         p_shard_params = partitioner.partition(self.model.to_bf16, (params_spec,), params_spec)
 
         # This will auto-magically run in mesh context
-        self.params = p_shard_params(freeze(jax_utils.unreplicate(self.params)))
+        self.params = freeze(p_shard_params(freeze(jax_utils.unreplicate(self.params))))
         self.is_sharded = True
 
-        def generate(params, input_features, forced_decoder_ids, return_timestamps):
+        def generate(params, input_features, forced_decoder_ids, return_timestamps, max_length):
             output_ids = self.model.pipeline_generate(
                 input_features,
                 params=params,
                 forced_decoder_ids=forced_decoder_ids,
                 return_timestamps=return_timestamps,
-                max_length=self.max_length,
+                max_length=max_length,
             )
             return output_ids
 
@@ -178,23 +179,25 @@ class FlaxWhisperPipline:
             generate,
             in_axis_resources=(params_spec, P("data"), None),
             out_axis_resources=P("data"),
-            static_argnums=(3,),
+            static_argnums=(3, 4),
         )
 
-    def generate(self, input_features, language=None, task=None, return_timestamps=False):
+    def generate(self, input_features, language=None, task=None, return_timestamps=False, max_length=None):
         forced_decoder_ids = self.get_forced_decoder_ids(
             language=language, task=task, return_timestamps=return_timestamps
         )
+        # the max length sets the static size of the output buffer, so generation is compiled once for each value of it
+        max_length = max_length if max_length is not None else self.max_length
         if not self.is_sharded:
             # if we're using pmap we need to manually replicate the input data across devices and gather the output tokens
             output_ids = self.p_generate(
-                freeze(self.params), shard(input_features), forced_decoder_ids, return_timestamps
+                self.params, shard(input_features), forced_decoder_ids, return_timestamps, max_length
             ).sequences
-            output_ids = jax.device_get(output_ids.reshape(-1, self.max_length))
+            output_ids = jax.device_get(output_ids.reshape(-1, max_length))
         else:
             # pjit handles replication / gathering for us auto-magically
             output_ids = self.p_generate(
-                freeze(self.params), input_features, forced_decoder_ids, return_timestamps
+                self.params, input_features, forced_decoder_ids, return_timestamps, max_length
             ).sequences
         return output_ids
 
@@ -389,7 +392,9 @@ class FlaxWhisperPipline:
         )
         return {"text": text, **optional}
 
-    def forward(self, model_inputs, batch_size=None, language=None, task=None, return_timestamps=False):
+    def forward(
+        self, model_inputs, batch_size=None, language=None, task=None, return_timestamps=False, max_length=None
+    ):
         # We need to keep track of some additional input arguments for post-processing so need to forward these on after running generation
         input_features = model_inputs.pop("input_features")
         input_batch_size = input_features.shape[0]
@@ -398,9 +403,9 @@ class FlaxWhisperPipline:
             padding = np.zeros([batch_size - input_batch_size, *input_features.shape[1:]], input_features.dtype)
             input_features = np.concatenate([input_features, padding])
 
-        pred_ids = self.generate(input_features, language=language, task=task, return_timestamps=return_timestamps)[
-            :input_batch_size
-        ]
+        pred_ids = self.generate(
+            input_features, language=language, task=task, return_timestamps=return_timestamps, max_length=max_length
+        )[:input_batch_size]
 
         # tokenizer's decode method expects an extra dim - we insert it here for convenience
         out = {"tokens": pred_ids[:, None, :]}
@@ -420,6 +425,7 @@ class FlaxWhisperPipline:
         language=None,
         task=None,
         return_timestamps=None,
+        max_length=None,
         generate_kwargs=None,
     ):
         """
@@ -467,6 +473,9 @@ class FlaxWhisperPipline:
                 Whether to return timestamps in the prediction. Defaults to False. If set to true, the pipeline
                 will return two keys in the output dictionary: `"text"` containing the text transcription, and `"chunks"`
                 containing the transcription segments chunked by their utterance-level timestamps.
+            max_length (`int`, *optional*):
+                The maximum numbers of tokens to generate for each chunk. Defaults to the `max_length` passed to the
+                `__init__` method. Generation is compiled once for each distinct value.
 
         Return:
             `Dict`: A dictionary with the following keys:
@@ -491,7 +500,12 @@ class FlaxWhisperPipline:
         for batch in dataloader:
             model_outputs.append(
                 self.forward(
-                    batch, batch_size=batch_size, language=language, task=task, return_timestamps=return_timestamps
+                    batch,
+                    batch_size=batch_size,
+                    language=language,
+                    task=task,
+                    return_timestamps=return_timestamps,
+                    max_length=max_length,
                 )
             )
         post_processed = self.postprocess(model_outputs, return_timestamps=return_timestamps)